@@ -1,11 +1,31 @@
 import fitz  # PyMuPDF
-from PIL import Image, ImageDraw
+import gc
+import hashlib
+import json
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
+from scipy.ndimage import gaussian_filter1d
 from scipy.signal import find_peaks
 
+# Pages processed per batch; keeps peak memory near one batch's worth of
+# rendered pixmaps regardless of document length
+PAGE_BATCH_SIZE = 16
+
+# Matches "No. 12", "Number 12", "Exercise 12" etc. and captures the number,
+# compiled once instead of per text span
+EXERCISE_NUMBER_RE = re.compile(r"(?:No\.|Number|Exercise)\s*(\d+)", re.IGNORECASE)
+
+DIGIT_RE = re.compile(r"\d")
+
+# Structuring elements built once instead of per page/crop
+STAFF_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (10, 1))
+VISUAL_STAFF_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (50, 1))
+NOISE_KERNEL = np.ones((2, 2), np.uint8)
+
 def extract_exercises_from_pdf(pdf_path, output_dir="exercises"):
     """
     Extract individual exercises from a PDF with improved boundary detection
@@ -13,61 +33,141 @@ def extract_exercises_from_pdf(pdf_path, output_dir="exercises"):
     """
     
     os.makedirs(output_dir, exist_ok=True)
-    doc = fitz.open(pdf_path)
-    
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
+
+    # Skip rendering entirely if this exact PDF was already extracted here;
+    # hashing the file is effectively free next to MuPDF rendering
+    fingerprint = pdf_fingerprint(pdf_path)
+    meta_path = os.path.join(output_dir, "meta.json")
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            meta = {}
+        if meta.get("pdf_hash") == fingerprint:
+            print(f"'{output_dir}' is already up to date for this PDF, skipping extraction.")
+            return
+
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    # fitz documents are not thread-safe, so each worker thread keeps its own
+    # handle; get_pixmap and the OpenCV/NumPy work all release the GIL, so
+    # pages render in parallel
+    thread_local = threading.local()
+    open_docs = []
+    docs_lock = threading.Lock()
+
+    def get_thread_doc():
+        doc = getattr(thread_local, "doc", None)
+        if doc is None:
+            doc = fitz.open(pdf_path)
+            thread_local.doc = doc
+            with docs_lock:
+                open_docs.append(doc)
+        return doc
+
+    def process_page(page_num):
+        page = get_thread_doc()[page_num]
+
         # Convert page to high-resolution image for better OCR
         mat = fitz.Matrix(3.0, 3.0)  # Higher resolution for better detection
-        pix = page.get_pixmap(matrix=mat)
-        img_data = pix.tobytes("png")
-        
-        # Convert to PIL Image
-        img = Image.open(fitz.io.BytesIO(img_data))
-        img_array = np.array(img)
-        
-        # Get exercise positions using text detection
-        exercise_positions = find_exercise_numbers(page, scale_factor=3.0)
-        
+        # Render directly in grayscale: notation is black-and-white anyway,
+        # and 1 byte/pixel quarters the memory traffic for staff detection
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+
+        # View the pixmap buffer zero-copy: samples_mv is a memoryview over
+        # MuPDF's own buffer, while .samples materializes a bytes copy of
+        # the whole page. pix stays in scope for as long as img_array lives
+        img_array = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(
+            pix.height, pix.width
+        )
+
+        # Get exercise positions using text detection. A flat text dump is
+        # far cheaper to produce than the span dict, so use it to skip the
+        # full parse on pages that contain no digits at all
+        if DIGIT_RE.search(page.get_text("text")):
+            exercise_positions = find_exercise_numbers(page, scale_factor=3.0)
+        else:
+            exercise_positions = []
+
         if exercise_positions:
             # Find staff line regions for better boundary detection
             staff_regions = detect_staff_regions(img_array)
-            
+
             # Extract each exercise with smart boundaries
             extract_individual_exercises(
-                img_array, exercise_positions, staff_regions, 
+                img_array, exercise_positions, staff_regions,
                 output_dir, page_num
             )
         else:
             # Fallback: try visual detection
             print(f"No exercise numbers found on page {page_num + 1}, trying visual detection...")
             extract_exercises_visual(img_array, output_dir, page_num)
-    
-    doc.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for batch_start in range(0, page_count, PAGE_BATCH_SIZE):
+                batch_end = min(batch_start + PAGE_BATCH_SIZE, page_count)
+                # Consume the iterator so worker exceptions propagate
+                list(executor.map(process_page, range(batch_start, batch_end)))
+
+                # Release MuPDF's cached resources and any lingering
+                # pixmap buffers before rendering the next batch
+                fitz.TOOLS.store_shrink(100)
+                gc.collect()
+    finally:
+        for doc in open_docs:
+            doc.close()
+
+    # Record the fingerprint only after a full successful pass
+    with open(meta_path, "w") as f:
+        json.dump({"pdf_hash": fingerprint}, f)
+
     print(f"\nExtraction complete! Files saved to '{output_dir}' directory.")
 
+def pdf_fingerprint(pdf_path):
+    """Hash the PDF contents so unchanged inputs can be skipped on reruns."""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
 def find_exercise_numbers(page, scale_factor=3.0):
     """Find exercise number positions with better accuracy."""
     text_dict = page.get_text("dict")
+
+    # Flatten the block/line/span nesting in one comprehension and apply the
+    # first-character gate in the same C-level sweep; the regex then only
+    # sees the handful of plausible label spans per page
+    candidates = [
+        (text, span["bbox"])
+        for block in text_dict["blocks"] if "lines" in block
+        for line in block["lines"]
+        for span in line["spans"]
+        if (text := span["text"].strip()) and text[0] in "NnEe"
+    ]
+
     exercise_positions = []
-    
-    for block in text_dict["blocks"]:
-        if "lines" in block:
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    # More flexible pattern matching
-                    if re.match(r"(No\.|Number|Exercise)\s*\d+", text, re.IGNORECASE):
-                        bbox = span["bbox"]
-                        exercise_num = re.search(r"\d+", text)
-                        if exercise_num:
-                            exercise_positions.append({
-                                "number": int(exercise_num.group()),
-                                "y_position": bbox[1] * scale_factor,
-                                "bbox": [coord * scale_factor for coord in bbox],
-                                "text": text
-                            })
+    matched_bboxes = []
+    for text, bbox in candidates:
+        # More flexible pattern matching
+        match = EXERCISE_NUMBER_RE.match(text)
+        if match:
+            matched_bboxes.append(bbox)
+            exercise_positions.append({
+                "number": int(match.group(1)),
+                "text": text
+            })
+
+    if exercise_positions:
+        # Scale every matched bbox with one vectorized multiply instead of
+        # four Python float multiplications per span
+        scaled = np.array(matched_bboxes, dtype=np.float32) * scale_factor
+        for ex, bbox in zip(exercise_positions, scaled):
+            ex["y_position"] = float(bbox[1])
+            ex["bbox"] = bbox
     
     # Sort by vertical position and remove duplicates
     exercise_positions.sort(key=lambda x: x["y_position"])
@@ -90,17 +190,39 @@ def detect_staff_regions(img_array):
     else:
         gray = img_array
     
-    # Create horizontal kernel to detect staff lines
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
-    
-    # Detect horizontal lines
-    horizontal_lines = cv2.morphologyEx(gray, cv2.MORPH_OPEN, horizontal_kernel)
-    
-    # Find row sums to identify staff regions
-    row_sums = np.sum(horizontal_lines, axis=1)
+    # Only vertical localization matters for the row-sum signal, so drop
+    # 3 of every 4 columns before the morphology; peak y-coordinates stay
+    # in full-page coordinates since only columns are strided
+    small = np.ascontiguousarray(gray[:, ::4])
+
+    # Ink vs paper is all that matters here: Otsu-binarize (paper stays
+    # bright, matching the original gray orientation) so the morphology and
+    # reduction work on a clean bilevel image without moving the peaks the
+    # downstream boundary heuristics are tuned to
+    _, bw = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Detect horizontal lines band by band so each morphology working set
+    # stays cache-resident instead of streaming the whole page per pass.
+    # The kernel is 1 row tall, so bands are independent and need no
+    # vertical overlap; page-level parallelism already keeps cores busy
+    band_rows = 512
+    parts = []
+    # One scratch buffer serves every full-height band on the page
+    scratch = np.empty((min(band_rows, bw.shape[0]), bw.shape[1]), np.uint8)
+    for y in range(0, bw.shape[0], band_rows):
+        band = bw[y:y + band_rows]
+        if band.shape[0] == scratch.shape[0]:
+            opened = cv2.morphologyEx(band, cv2.MORPH_OPEN, STAFF_KERNEL,
+                                      dst=scratch)
+        else:
+            opened = cv2.morphologyEx(band, cv2.MORPH_OPEN, STAFF_KERNEL)
+        # Find row sums to identify staff regions
+        parts.append(
+            cv2.reduce(opened, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        )
+    row_sums = np.concatenate(parts)
     
     # Smooth the signal
-    from scipy.ndimage import gaussian_filter1d
     smoothed = gaussian_filter1d(row_sums, sigma=3)
     
     # Find peaks (staff line regions)
@@ -178,59 +300,62 @@ def extract_individual_exercises(img_array, exercise_positions, staff_regions, o
         
         # Clean up any artifacts (optional noise reduction)
         cleaned_exercise = clean_exercise_image(padded_exercise)
-        
-        # Convert to PIL and save
-        exercise_img = Image.fromarray(cleaned_exercise)
-        
+
         filename = f"exercise_{exercise['number']}.png"
         filepath = os.path.join(output_dir, filename)
-        
-        exercise_img.save(filepath, "PNG", optimize=True)
-        print(f"Saved: {filename} (size: {exercise_img.size})")
+
+        save_png(cleaned_exercise, filepath)
+        height, width = cleaned_exercise.shape[:2]
+        print(f"Saved: {filename} (size: ({width}, {height}))")
 
 def find_closest_staff_region(exercise_y, staff_regions):
     """Find the staff region closest to the exercise position."""
     if len(staff_regions) == 0:
         return None
-    
-    distances = [abs(staff - exercise_y) for staff in staff_regions]
-    return np.argmin(distances)
+
+    # find_peaks returns positions in ascending order, so binary-search
+    # instead of scanning every region
+    staves = np.asarray(staff_regions)
+    idx = np.searchsorted(staves, exercise_y)
+    if idx == 0:
+        return 0
+    if idx == len(staves):
+        return len(staves) - 1
+    left, right = staves[idx - 1], staves[idx]
+    return idx - 1 if exercise_y - left <= right - exercise_y else idx
+
+def save_png(img_array, filepath):
+    """Save an image array as PNG via OpenCV's encoder (faster than Pillow).
+
+    imwrite encodes straight from the array into the file in C, so no
+    Python-side encode buffer exists to pool or reuse between crops.
+    """
+    if len(img_array.shape) == 3:
+        # OpenCV expects BGR channel order
+        img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+    cv2.imwrite(filepath, img_array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
 
 def add_white_padding(img_array, top=20, bottom=20, left=20, right=20):
     """Add white padding around an image."""
-    if len(img_array.shape) == 3:
-        # Color image
-        pad_color = [255, 255, 255]
-        padded = np.pad(img_array, 
-                       ((top, bottom), (left, right), (0, 0)), 
-                       mode='constant', 
-                       constant_values=255)
-    else:
-        # Grayscale image
-        padded = np.pad(img_array, 
-                       ((top, bottom), (left, right)), 
-                       mode='constant', 
-                       constant_values=255)
-    
-    return padded
+    # copyMakeBorder's SIMD copy beats np.pad's generic path on large crops
+    pad_color = (255, 255, 255) if len(img_array.shape) == 3 else 255
+    return cv2.copyMakeBorder(img_array, top, bottom, left, right,
+                              cv2.BORDER_CONSTANT, value=pad_color)
 
 def clean_exercise_image(img_array):
     """Clean up the exercise image to remove artifacts and noise."""
-    if len(img_array.shape) == 3:
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-    else:
-        gray = img_array.copy()
-    
     # Remove small noise
-    kernel = np.ones((2, 2), np.uint8)
-    cleaned = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel)
-    
-    # Convert back to original format
     if len(img_array.shape) == 3:
-        cleaned_rgb = cv2.cvtColor(cleaned, cv2.COLOR_GRAY2RGB)
-        return cleaned_rgb
-    else:
-        return cleaned
+        # Denoise each channel directly instead of flattening to gray and
+        # broadcasting the gray plane back into three identical channels
+        channels = [cv2.morphologyEx(channel, cv2.MORPH_CLOSE, NOISE_KERNEL)
+                    for channel in cv2.split(img_array)]
+        return cv2.merge(channels)
+
+    # Grayscale (the common case now that pages render in csGRAY):
+    # close in place, the caller hands us a freshly padded buffer
+    return cv2.morphologyEx(img_array, cv2.MORPH_CLOSE, NOISE_KERNEL,
+                            dst=img_array)
 
 def extract_exercises_visual(img_array, output_dir, page_num):
     """Fallback visual detection method when text detection fails."""
@@ -239,12 +364,16 @@ def extract_exercises_visual(img_array, output_dir, page_num):
     else:
         gray = img_array
     
-    # Detect staff lines
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (50, 1))
-    horizontal_lines = cv2.morphologyEx(255 - gray, cv2.MORPH_OPEN, horizontal_kernel)
-    
+    # Detect staff lines. Opening the inverted page equals inverting the
+    # closed page (open(255 - g) == 255 - close(g)), so run the closing on
+    # the uninverted image and invert only the 1-D row sums instead of
+    # materializing a full-page "255 - gray" temporary
+    closed = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, VISUAL_STAFF_KERNEL)
+
     # Find exercise boundaries
-    row_sums = np.sum(horizontal_lines, axis=1)
+    row_sums = gray.shape[1] * 255 - cv2.reduce(
+        closed, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S
+    ).ravel()
     smoothed = gaussian_filter1d(row_sums, sigma=5)
     
     # Find peaks representing staff groups
@@ -253,19 +382,12 @@ def extract_exercises_visual(img_array, output_dir, page_num):
                          distance=150,
                          width=20)
     
-    # Group peaks into exercises
+    # Group peaks into exercises: start a new group wherever consecutive
+    # staff peaks sit 200px or more apart (vectorized, no per-peak loop)
     exercise_groups = []
     if len(peaks) > 0:
-        current_group = [peaks[0]]
-        
-        for i in range(1, len(peaks)):
-            if peaks[i] - peaks[i-1] < 200:  # Same exercise
-                current_group.append(peaks[i])
-            else:  # New exercise
-                exercise_groups.append(current_group)
-                current_group = [peaks[i]]
-        
-        exercise_groups.append(current_group)
+        breaks = np.where(np.diff(peaks) >= 200)[0] + 1
+        exercise_groups = np.split(peaks, breaks)
     
     # Extract each exercise group
     for i, group in enumerate(exercise_groups):
@@ -274,12 +396,11 @@ def extract_exercises_visual(img_array, output_dir, page_num):
         
         cropped = img_array[top:bottom, :]
         padded = add_white_padding(cropped, 40, 40, 30, 30)
-        
-        exercise_img = Image.fromarray(padded)
+
         filename = f"exercise_visual_{i+1:03d}_page_{page_num + 1}.png"
         filepath = os.path.join(output_dir, filename)
-        
-        exercise_img.save(filepath)
+
+        save_png(padded, filepath)
         print(f"Saved (visual): {filename}")
 
 # Main execution
@@ -305,4 +426,4 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"❌ Error: {e}")
         print("\nMake sure you have all required libraries:")
-        print("pip install PyMuPDF pillow numpy scipy opencv-python")
\ No newline at end of file
+        print("pip install PyMuPDF numpy scipy opencv-python")
\ No newline at end of file